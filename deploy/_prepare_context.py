@@ -0,0 +1,335 @@
+"""
+Shared logic behind the deploy/*/prepare_context.py entrypoints.
+Reads the deployment payload from AWS Secrets Manager (passed via SECRET_JSON),
+materialises the SSH key + env file, and emits GitHub Action outputs.
+"""
+
+from __future__ import annotations
+
+import binascii
+import hashlib
+import os
+import pathlib
+import sys
+import time
+
+try:
+    # orjson parses straight from bytes and is considerably faster than the
+    # stdlib parser; fall back to json so the script works on a bare runner.
+    import orjson as _json
+except ImportError:
+    import json as _json  # type: ignore[no-redef]
+
+try:
+    # fastjsonschema compiles the schema to a plain function, validating the
+    # whole secret in one pass with a precise error message.
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
+
+
+# Maps each .env key to the AWS secret keys that may hold its value, in
+# order of preference.
+_ENV_MAP = (
+    ("DB_HOST", ("DATABASE_ENDPOINT", "RDS_HOSTNAME", "DB_HOST")),
+    ("DB_NAME", ("DATABASE_NAME", "RDS_DB_NAME", "DB_NAME")),
+    ("DB_USER", ("DATABASE_USERNAME", "RDS_USERNAME", "DB_USER")),
+    ("DB_PASSWORD", ("DATABASE_PASSWORD", "RDS_PASSWORD", "DB_PASSWORD")),
+    ("DB_PORT", ("DATABASE_PORT", "RDS_PORT", "DB_PORT")),
+)
+
+# Secret keys copied into the env file verbatim when present. These are
+# consumed by the container and the backup cron job.
+_ENV_PASSTHROUGH = (
+    "SITE_URL",
+    "BUCKET_NAME",
+    "BUCKET_ENDPOINT",
+    "BUCKET_REGION",
+    "BUCKET_ACCESS_KEY_ID",
+    "BUCKET_SECRET_ACCESS_KEY",
+    "FILES_BACK_UP_HOURS",
+)
+
+
+# How long a cached mapped secret stays valid on the runner.
+_CACHE_TTL_SECONDS = 24 * 60 * 60
+
+# Shape of the mapped secret; compiled once at import time when
+# fastjsonschema is available.
+_SECRET_SCHEMA = {
+    "type": "object",
+    "required": [
+        "lightsail_host",
+        "lightsail_user",
+        "lightsail_private_key_b64",
+        "remote_project_path",
+    ],
+    "properties": {
+        "lightsail_host": {"type": "string", "minLength": 1},
+        "lightsail_user": {"type": "string", "minLength": 1},
+        "lightsail_port": {"type": ["string", "integer"]},
+        "lightsail_private_key_b64": {"type": "string", "minLength": 32},
+        "remote_project_path": {"type": "string", "minLength": 1},
+        "docker_compose_file": {"type": "string"},
+        "env_file_content": {"type": "string"},
+    },
+}
+
+_validate_secret = fastjsonschema.compile(_SECRET_SCHEMA) if fastjsonschema else None
+
+
+def fail(message: str) -> None:
+    print(f"[prepare_context] {message}", file=sys.stderr)
+    raise SystemExit(1)
+
+
+def _cache_path(secret_json: bytes) -> pathlib.Path:
+    digest = hashlib.sha256(secret_json).hexdigest()
+    tmp_dir = pathlib.Path(os.environ.get("RUNNER_TEMP", "/tmp"))
+    return tmp_dir / f"prepare_context-{digest}.json"
+
+
+def _load_cache(cache_path: pathlib.Path) -> dict | None:
+    """Return the mapped secret cached by an earlier run on this runner, if fresh."""
+    try:
+        if time.time() - cache_path.stat().st_mtime > _CACHE_TTL_SECONDS:
+            return None
+        return _json.loads(cache_path.read_bytes())
+    except (OSError, ValueError):
+        return None
+
+
+def _store_cache(cache_path: pathlib.Path, secret: dict) -> None:
+    data = _json.dumps(secret)
+    if isinstance(data, str):  # stdlib json returns str, orjson returns bytes
+        data = data.encode("utf-8")
+    # The cache holds credentials: create it 0o600 and publish atomically.
+    # A cache write failure must not fail the deploy, so swallow OSError.
+    tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+    try:
+        fd = os.open(str(tmp_path), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+
+
+def _write_secret_file(path: pathlib.Path, data: bytes) -> None:
+    """Create ``path`` with mode 0o600 in one open, never exposing the
+    default umask; a stale file from a previous run is removed and the
+    create retried once."""
+    for _ in range(2):
+        try:
+            fd = os.open(str(path), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            path.unlink(missing_ok=True)
+            continue
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        return
+    fail(f"Unable to create {path} securely")
+
+
+def _build_secret(secret_json: bytes) -> dict:
+    """Parse SECRET_JSON and map the AWS secret keys to the keys we expect."""
+    try:
+        # Parse the secret JSON
+        secret = _json.loads(secret_json)
+        # AWS Secrets Manager envelope: the payload is embedded as an escaped
+        # JSON string under 'SecretString'. Re-parse only in that case — the
+        # workflow passes `--query SecretString --output text` to the AWS CLI,
+        # so normally the single parse above is all the JSON work done.
+        if isinstance(secret, dict):
+            inner = secret.get("SecretString")
+            if isinstance(inner, str):
+                secret = _json.loads(inner)
+            elif inner is not None:
+                secret = inner
+    except ValueError as exc:
+        # Both json.JSONDecodeError and orjson.JSONDecodeError subclass ValueError
+        fail(f"Unable to parse SECRET_JSON: {exc}")
+
+    # Plain-text or list-valued secrets parse fine but can't be mapped.
+    if not isinstance(secret, dict):
+        fail("SECRET_JSON must be a JSON object")
+
+    # Handle AWS Secrets Manager key-value format
+    # Keys from the image: LIGHTSAIL_IP, lightsail_host, lightsail_user, etc.
+    # Map AWS secret keys to our expected keys
+    secret_mapped = {}
+    
+    # Direct mappings (if keys match exactly)
+    for key in ["lightsail_host", "lightsail_user", "lightsail_port", "lightsail_private_key_b64", 
+                "remote_project_path", "docker_compose_file", "env_file_content"]:
+        if key in secret:
+            secret_mapped[key] = secret[key]
+    
+    # Handle LIGHTSAIL_IP -> lightsail_host mapping
+    if "LIGHTSAIL_IP" in secret and "lightsail_host" not in secret_mapped:
+        secret_mapped["lightsail_host"] = secret["LIGHTSAIL_IP"]
+    if "lightsail_host" in secret and "lightsail_host" not in secret_mapped:
+        secret_mapped["lightsail_host"] = secret["lightsail_host"]
+    
+    # Handle lightsail_user
+    if "lightsail_user" in secret:
+        secret_mapped["lightsail_user"] = secret["lightsail_user"]
+    elif "LIGHTSAIL_USER" in secret:
+        secret_mapped["lightsail_user"] = secret["LIGHTSAIL_USER"]
+    
+    # Handle lightsail_port
+    if "lightsail_port" in secret:
+        secret_mapped["lightsail_port"] = secret["lightsail_port"]
+    elif "LIGHTSAIL_PORT" in secret:
+        secret_mapped["lightsail_port"] = secret["LIGHTSAIL_PORT"]
+    
+    # Handle private key
+    if "lightsail_private_key_b64" in secret:
+        secret_mapped["lightsail_private_key_b64"] = secret["lightsail_private_key_b64"]
+    
+    # Build env_file_content from database + site + bucket configuration
+    # Note: Frappe uses MariaDB/MySQL, not PostgreSQL.
+    # If using Lightsail database, ensure it's MariaDB/MySQL compatible.
+    env_values: dict[str, str] = {}
+    for out_key, candidates in _ENV_MAP:
+        for candidate in candidates:
+            value = secret.get(candidate)
+            if value:
+                env_values[out_key] = value
+                break
+    if "DB_HOST" in env_values and "DB_PORT" not in env_values:
+        # Default to 3306 for MariaDB/MySQL (Frappe's default)
+        env_values["DB_PORT"] = "3306"
+
+    # Add site name and URL
+    # Use SITE_NAME from secrets if available, otherwise use domain without www
+    if "SITE_NAME" in secret:
+        env_values["SITE_NAME"] = secret["SITE_NAME"]
+    elif "LIGHTSAIL_IP" in secret:
+        # Fallback: Use the IP as site name, replacing dots with underscores
+        env_values["SITE_NAME"] = secret["LIGHTSAIL_IP"].replace(".", "_")
+    elif "lightsail_host" in secret_mapped:
+        # Fallback to host if IP not available
+        env_values["SITE_NAME"] = secret_mapped["lightsail_host"].replace(".", "_")
+
+    for key in _ENV_PASSTHROUGH:
+        if key in secret:
+            env_values[key] = secret[key]
+
+    env_parts = [f"{key}={value}" for key, value in env_values.items()]
+
+    # Add any existing env_file_content or use the built one
+    if "env_file_content" in secret:
+        secret_mapped["env_file_content"] = secret["env_file_content"]
+    elif env_parts:
+        secret_mapped["env_file_content"] = "\n".join(env_parts) + "\n"
+    
+    # Set default remote path if not provided
+    if "remote_project_path" not in secret_mapped:
+        secret_mapped["remote_project_path"] = "/opt/frappe-hrms"
+    
+    # Set default compose file if not provided
+    if "docker_compose_file" not in secret_mapped:
+        secret_mapped["docker_compose_file"] = "docker/docker-compose.yml"
+
+    return secret_mapped
+
+
+def run(base_dir: str) -> None:
+    """Prepare the deployment context for the target under ``base_dir``.
+
+    ``base_dir`` is the deploy directory relative to the repo root, e.g.
+    ``deploy/dev``; the env file is materialised at ``<base_dir>/.env.remote``.
+    """
+    # environb hands us the secret as raw bytes, skipping the str decode of
+    # a potentially large payload; both parsers accept bytes directly.
+    secret_json = os.environb.get(b"SECRET_JSON")
+    if not secret_json:
+        fail("SECRET_JSON environment variable is empty")
+
+    # Reuse the mapped secret from an earlier invocation on the same runner
+    # (matrix jobs, retries) instead of re-parsing and re-mapping.
+    cache_path = _cache_path(secret_json)
+    secret = _load_cache(cache_path)
+    if secret is None:
+        secret = _build_secret(secret_json)
+        _store_cache(cache_path, secret)
+
+    if _validate_secret is not None:
+        try:
+            _validate_secret(secret)
+        except fastjsonschema.JsonSchemaException as exc:
+            fail(f"Invalid AWS secret: {exc}")
+    else:
+        required_fields = [
+            "lightsail_host",
+            "lightsail_user",
+            "lightsail_private_key_b64",
+            "remote_project_path",
+        ]
+        missing = [field for field in required_fields if not secret.get(field)]
+        if missing:
+            fail(f"Missing required keys in AWS secret: {', '.join(missing)}")
+
+    ssh_dir = pathlib.Path.home() / ".ssh"
+    ssh_dir.mkdir(parents=True, exist_ok=True)
+    ssh_dir.chmod(0o700)
+
+    key_path = ssh_dir / "lightsail"
+    b64_value = secret["lightsail_private_key_b64"]
+    try:
+        # a2b_base64 is the C routine underneath base64.b64decode and
+        # tolerates the newline-wrapped base64 produced by `base64 key`.
+        key_bytes = binascii.a2b_base64(
+            b64_value.strip() if isinstance(b64_value, str) else b64_value
+        )
+    except (ValueError, binascii.Error):
+        fail("lightsail_private_key_b64 is not valid base64 data")
+
+    _write_secret_file(key_path, key_bytes)
+
+    env_content = secret.get("env_file_content", "")
+    env_path = pathlib.Path(base_dir) / ".env.remote"
+    env_path.parent.mkdir(parents=True, exist_ok=True)
+    # The env file carries DB credentials, so it gets the same treatment.
+    _write_secret_file(env_path, env_content.encode("utf-8"))
+
+    compose_file = secret.get("docker_compose_file", "docker/docker-compose.yml")
+    lightsail_port = str(secret.get("lightsail_port", "22"))
+
+    outputs = {
+        "host": secret["lightsail_host"],
+        "user": secret["lightsail_user"],
+        "ssh_key_path": str(key_path),
+        "remote_path": secret["remote_project_path"],
+        "port": lightsail_port,
+        "compose_file": compose_file,
+        "env_file": str(env_path),
+        "env_content": env_content,
+    }
+
+    output_file = os.environ.get("GITHUB_OUTPUT")
+    if not output_file:
+        fail("GITHUB_OUTPUT is not defined")
+
+    chunks: list[str] = []
+    for key, value in outputs.items():
+        if key == "env_content":
+            # Use multiline format for env_content
+            chunks.append(f"{key}<<EOF\n{value}\nEOF\n")
+        else:
+            chunks.append(f"{key}={value}\n")
+
+    # Append everything in a single write so the block stays contiguous
+    # even if another step appends to GITHUB_OUTPUT concurrently.
+    payload = "".join(chunks).encode("utf-8")
+    fd = os.open(output_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+    try:
+        os.write(fd, payload)
+    finally:
+        os.close(fd)
+